@@ -0,0 +1,71 @@
+"""Process-pool tasks for PDF text extraction and OCR.
+
+These live outside app.py so pool workers only import PyPDF2 (and the OCR
+libraries when a page is OCR'd) instead of the whole Flask app. Tasks take
+plain arguments: a PDF is its bytes or a file path.
+"""
+import io
+import time
+from collections import OrderedDict
+
+import PyPDF2
+
+
+def extract_page_range(source, start, end, deadline=None):
+    """Text of pages [start, end) of one PDF ('' for pages that fail).
+
+    Stops early once `deadline` (epoch seconds) has passed, so the result can
+    be shorter than the range.
+    """
+    pdf_file = io.BytesIO(source) if isinstance(source, bytes) else open(source, 'rb')
+    with pdf_file:
+        pdf_reader = PyPDF2.PdfReader(pdf_file)
+        if pdf_reader.is_encrypted:
+            pdf_reader.decrypt('')
+        texts = []
+        for index in range(start, min(end, len(pdf_reader.pages))):
+            if deadline is not None and time.time() >= deadline:
+                break
+            try:
+                texts.append(pdf_reader.pages[index].extract_text() or '')
+            except Exception as page_error:
+                print(f"Error extracting text from page {index + 1}: {page_error}")
+                texts.append('')
+        return texts
+
+
+def ocr_image(image):
+    """OCR one image; returns (text, mean word confidence 0-100)."""
+    import pytesseract
+
+    data = pytesseract.image_to_data(image, lang='eng', output_type=pytesseract.Output.DICT)
+    lines = OrderedDict()
+    confidences = []
+    for i, word in enumerate(data.get('text', [])):
+        try:
+            confidence = float(data['conf'][i])
+        except (TypeError, ValueError):
+            confidence = -1.0
+        if not word or not word.strip() or confidence < 0:
+            continue
+        confidences.append(confidence)
+        key = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        lines.setdefault(key, []).append(word)
+    text = "\n".join(" ".join(words) for words in lines.values())
+    return text, (sum(confidences) / len(confidences) if confidences else 0.0)
+
+
+def ocr_page(file_path, page_number, first_pass_dpi, retry_dpi, min_confidence):
+    """OCR a single 1-based page, re-rendering at `retry_dpi` if confidence is low."""
+    from pdf2image import convert_from_path
+
+    text, confidence, dpi = '', 0.0, first_pass_dpi
+    for dpi in (first_pass_dpi, retry_dpi):
+        images = convert_from_path(file_path, dpi=dpi, first_page=page_number, last_page=page_number, grayscale=True)
+        if not images:
+            break
+        text, confidence = ocr_image(images[0])
+        images[0].close()
+        if confidence >= min_confidence or dpi >= retry_dpi:
+            break
+    return text, confidence, dpi
@@ -1,17 +1,38 @@
-import os
-from app import app, db, init_db
+"""
+Apply pending database migrations.
+
+Usage:
+    python run_migration.py            apply pending migrations
+    python run_migration.py --status   show applied and pending migrations
+"""
+import sys
+from app import app, run_migrations, schema_version, SCHEMA_MIGRATIONS, SCHEMA_VERSION
+
+def show_status():
+    with app.app_context():
+        current = schema_version()
+        print(f"Database schema version: {current} (latest: {SCHEMA_VERSION})")
+        for version, name, _ in SCHEMA_MIGRATIONS:
+            state = "applied" if version <= current else "pending"
+            print(f"  {version:>4}  {state:<8} {name}")
 
 def run_standalone_migration():
-    print("🚀 Starting standalone database migration...")
+    print("🚀 Starting database migration...")
     try:
         with app.app_context():
-            init_db()
-            print("✅ Migration completed successfully!")
-            print("You can now start your Flask app and login as a student.")
+            applied = run_migrations()
+            if applied:
+                print(f"✅ Applied migrations: {', '.join(str(v) for v in applied)}")
+            else:
+                print("✅ Database schema is already up to date.")
     except Exception as e:
         print(f"❌ Migration failed: {str(e)}")
         import traceback
         traceback.print_exc()
+        sys.exit(1)
 
 if __name__ == "__main__":
-    run_standalone_migration()
+    if "--status" in sys.argv[1:]:
+        show_status()
+    else:
+        run_standalone_migration()
@@ -0,0 +1,36 @@
+// Helpers for the streamed (text/event-stream) AI endpoints
+
+// Read a text/event-stream fetch response, calling onEvent(eventName, data) per event
+async function readEventStream(response, onEvent) {
+    const reader = response.body.getReader();
+    const decoder = new TextDecoder();
+    let buffer = '';
+    while (true) {
+        const { value, done } = await reader.read();
+        if (done) break;
+        buffer += decoder.decode(value, { stream: true });
+        let sep;
+        while ((sep = buffer.indexOf('\n\n')) !== -1) {
+            const block = buffer.slice(0, sep);
+            buffer = buffer.slice(sep + 2);
+            let eventName = 'message';
+            let data = '';
+            block.split('\n').forEach((line) => {
+                if (line.startsWith('event:')) eventName = line.slice(6).trim();
+                else if (line.startsWith('data:')) data += line.slice(5).trim();
+            });
+            if (data) onEvent(eventName, JSON.parse(data));
+        }
+    }
+}
+
+// Best-effort value of a string field from incomplete streamed JSON
+function partialJsonField(text, key) {
+    const match = text.match(new RegExp('"' + key + '"\\s*:\\s*"((?:[^"\\\\]|\\\\.)*)'));
+    if (!match) return '';
+    try {
+        return JSON.parse('"' + match[1].replace(/\\$/, '') + '"');
+    } catch (e) {
+        return match[1];
+    }
+}
@@ -0,0 +1,72 @@
+"""Compile and run the batched C/C++ harness the way Piston does."""
+import os
+import shutil
+import subprocess
+
+import pytest
+
+# Keep the import from creating ./unittest.db (init_db only runs eagerly without DATABASE_URL)
+os.environ.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+
+from app import _build_batch_harness_files, _parse_batch_harness_output
+
+MARK = '@@UNITEST-test'
+
+C_SOLUTION = r'''
+#include <stdio.h>
+#include <stdlib.h>
+static int calls = 0;
+int main(void) {
+    int a, b;
+    calls++;
+    if (scanf("%d %d", &a, &b) != 2) return 3;
+    if (a < 0) exit(4);
+    printf("%d %d\n", a + b, calls);
+}
+'''
+
+CPP_SOLUTION = r'''
+#include <bits/stdc++.h>
+using namespace std;
+#define int long long
+static vector<int> seen;
+int32_t main() {
+    int a, b;
+    if (!(cin >> a >> b)) return 3;
+    if (a < 0) exit(4);
+    seen.push_back(a);
+    cout << a + b << " " << seen.size() << endl;
+}
+'''
+
+CASES = ['1 2\n', '-1 5\n', '', '40 2\n']
+
+
+def _run_harness(tmp_path, code, language, compiler):
+    if not shutil.which(compiler[0]):
+        pytest.skip(f'{compiler[0]} not installed')
+    files = _build_batch_harness_files(code, language, CASES, 2, MARK)
+    for entry in files:
+        (tmp_path / entry['name']).write_text(entry['content'])
+    build = subprocess.run(
+        compiler + ['-o', 'harness', files[0]['name'], '-lm'],
+        cwd=tmp_path, capture_output=True, text=True
+    )
+    assert build.returncode == 0, build.stderr
+    run = subprocess.run(['./harness'], cwd=tmp_path, capture_output=True, text=True, timeout=30)
+    assert run.returncode == 0, run.stderr
+    return _parse_batch_harness_output(run.stdout, MARK, len(CASES))
+
+
+@pytest.mark.parametrize('language, code, compiler', [
+    ('c', C_SOLUTION, ['gcc', '-std=c11', '-Wall']),
+    ('cpp', CPP_SOLUTION, ['g++', '-std=c++17', '-Wall']),
+])
+def test_native_harness_compiles_and_keeps_exit_status(tmp_path, language, code, compiler):
+    results = _run_harness(tmp_path, code, language, compiler)
+    assert results is not None
+    # Falling off the end of main is exit status 0; state is fresh for every case
+    assert results[0] == dict(results[0], status='success', output='3 1')
+    assert results[1]['status'] == 'error' and results[1]['message'] == 'Runtime Error'
+    assert results[2]['status'] == 'error' and results[2]['message'] == 'Runtime Error'
+    assert results[3] == dict(results[3], status='success', output='42 1')
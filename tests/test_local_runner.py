@@ -0,0 +1,67 @@
+"""Resource limits of the local code runner.
+
+bwrap is usually not installed where the tests run, so a stand-in that
+applies --chdir/--setenv and execs the command takes its place. The rlimits
+under test are set by the launcher itself, so they apply either way.
+"""
+import os
+import stat
+import sys
+
+import pytest
+
+# Keep the import from creating ./unittest.db (init_db only runs eagerly without DATABASE_URL)
+os.environ.setdefault('DATABASE_URL', 'sqlite:///:memory:')
+
+import app as unitest_app
+
+FAKE_BWRAP = r'''#!__PYTHON__
+import os, sys
+NO_ARG = {'--unshare-user', '--unshare-pid', '--unshare-net', '--unshare-ipc', '--unshare-uts',
+          '--unshare-cgroup-try', '--die-with-parent', '--clearenv'}
+ONE_ARG = {'--uid', '--gid', '--cap-drop', '--hostname', '--proc', '--dev', '--tmpfs', '--chdir'}
+TWO_ARGS = {'--ro-bind-try', '--bind', '--setenv'}
+args = sys.argv[1:]
+env = dict(os.environ)
+while args and args[0].startswith('--'):
+    opt = args.pop(0)
+    if opt == '--clearenv':
+        env = {}
+    elif opt == '--chdir':
+        os.chdir(args[0])
+    elif opt == '--setenv':
+        env[args[0]] = args[1]
+    if opt in ONE_ARG:
+        del args[:1]
+    elif opt in TWO_ARGS:
+        del args[:2]
+    elif opt not in NO_ARG:
+        sys.exit('unknown option ' + opt)
+os.execvpe(args[0], args, env)
+'''
+
+
+@pytest.fixture
+def local_runner(tmp_path, monkeypatch):
+    fake = tmp_path / 'bwrap'
+    fake.write_text(FAKE_BWRAP.replace('__PYTHON__', sys.executable))
+    fake.chmod(fake.stat().st_mode | stat.S_IXUSR)
+    monkeypatch.setattr(unitest_app, 'CODE_RUNNER_SANDBOX_BIN', str(fake))
+    monkeypatch.setattr(unitest_app, 'CODE_RUNNER_WARM_WORKERS', 0)
+    monkeypatch.setattr(unitest_app, '_local_sandbox_ok', None)
+    monkeypatch.setattr(unitest_app, '_local_runner_base', None)
+    monkeypatch.setenv('CODE_RUNNER_WORKDIR', str(tmp_path))
+    return unitest_app._local_execute_code
+
+
+def test_python_within_memory_limit(local_runner):
+    result = local_runner('print(len(bytearray(16 * 1024 * 1024)))', 'python', '', time_limit=5, memory_limit=128)
+    assert result['status'] == 'success', result
+    assert result['output'] == str(16 * 1024 * 1024)
+
+
+def test_python_over_memory_limit(local_runner):
+    code = 'data = bytearray(512 * 1024 * 1024)\nprint(len(data))'
+    result = local_runner(code, 'python', '', time_limit=5, memory_limit=64)
+    assert result['status'] == 'error'
+    assert result['message'] == 'Memory Limit Exceeded', result